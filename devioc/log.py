@@ -2,8 +2,10 @@
 This module implements utility classes and functions for logging.
 """
 
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 LOG_LEVEL = logging.DEBUG
 IMPORTANT = 25
@@ -21,33 +23,33 @@ class TermColor(object):
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-    @classmethod
-    def warn(cls, text):
-        return '{}{}{}'.format(cls.WARNING, text, cls.ENDC)
+    @staticmethod
+    def warn(text):
+        return f'\033[93m{text}\033[0m'
 
-    @classmethod
-    def success(cls, text):
-        return '{}{}{}'.format(cls.OKGREEN, text, cls.ENDC)
+    @staticmethod
+    def success(text):
+        return f'\033[92m{text}\033[0m'
 
-    @classmethod
-    def error(cls, text):
-        return '{}{}{}'.format(cls.FAIL, text, cls.ENDC)
+    @staticmethod
+    def error(text):
+        return f'\033[91m{text}\033[0m'
 
-    @classmethod
-    def emphasis(cls, text):
-        return '{}{}{}'.format(cls.BOLD, text, cls.ENDC)
+    @staticmethod
+    def emphasis(text):
+        return f'\033[1m{text}\033[0m'
 
-    @classmethod
-    def debug(cls, text):
-        return '{}{}{}'.format(cls.OKBLUE, text, cls.ENDC)
+    @staticmethod
+    def debug(text):
+        return f'\033[94m{text}\033[0m'
 
-    @classmethod
-    def normal(cls, text):
+    @staticmethod
+    def normal(text):
         return text
 
-    @classmethod
-    def underline(cls, text):
-        return '{}{}{}'.format(cls.UNDERLINE, text, cls.ENDC)
+    @staticmethod
+    def underline(text):
+        return f'\033[4m{text}\033[0m'
 
 
 class NullHandler(logging.Handler):
@@ -58,23 +60,42 @@ class NullHandler(logging.Handler):
 
 
 class ColoredConsoleHandler(logging.StreamHandler):
+    _COLOR = {
+        logging.DEBUG: TermColor.debug,
+        logging.WARNING: TermColor.warn,
+        logging.ERROR: TermColor.error,
+        logging.CRITICAL: TermColor.error,
+    }
+
+    def __init__(self, stream=None):
+        super(ColoredConsoleHandler, self).__init__(stream)
+        self.colorize = getattr(self.stream, 'isatty', lambda: False)()
+
+    def emit(self, record):
+        # discard filtered records before any formatting work is done
+        if record.levelno < self.level:
+            return
+        super(ColoredConsoleHandler, self).emit(record)
+
     def format(self, record):
         msg = super(ColoredConsoleHandler, self).format(record)
-        if record.levelno == logging.WARNING:
-            msg = TermColor.warn(msg)
-        elif record.levelno > logging.WARNING:
-            msg = TermColor.error(msg)
-        elif record.levelno == logging.DEBUG:
-            msg = TermColor.debug(msg)
-        return msg
+        if not self.colorize:
+            return msg
+        wrap = self._COLOR.get(record.levelno)
+        return wrap(msg) if wrap else msg
+
+
+_NULL_HANDLER = NullHandler()
+_CONFIGURED = set()
 
 
 def get_module_logger(name):
     """A factory which creates loggers with the given name and returns it."""
     name = name.split('.')[-1]
     logger = logging.getLogger(name)
-    logger.setLevel(LOG_LEVEL)
-    logger.addHandler(NullHandler())
+    if name not in _CONFIGURED:
+        logger.addHandler(_NULL_HANDLER)
+        _CONFIGURED.add(name)
     return logger
 
 
@@ -88,16 +109,27 @@ def log_to_console(level=LOG_LEVEL):
     else:
         formatter = logging.Formatter('%(asctime)s - %(message)s', '%b/%d %H:%M:%S')
     console.setFormatter(formatter)
-    logging.getLogger('').addHandler(console)
+    root = logging.getLogger('')
+    root.setLevel(min(level, root.getEffectiveLevel()))
+    root.addHandler(console)
 
 
 def log_to_file(filename, level=logging.DEBUG):
-    """Add a log handler which logs to the console."""
+    """Add a log handler which logs to a file from a background thread."""
     logfile = RotatingFileHandler(filename, maxBytes=1e6, backupCount=10)
     logfile.setLevel(level)
     formatter = logging.Formatter('%(asctime)s [%(name)s] %(message)s', '%b/%d %H:%M:%S')
     logfile.setFormatter(formatter)
-    logging.getLogger('').addHandler(logfile)
+
+    # hand records off to a queue so file I/O never blocks the calling thread
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, logfile, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger('')
+    root.setLevel(min(level, root.getEffectiveLevel()))
+    root.addHandler(QueueHandler(log_queue))
 
 
 logger = get_module_logger(__name__)
\ No newline at end of file
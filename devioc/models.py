@@ -1,17 +1,14 @@
-import multiprocessing
 import os
 import platform
 import shutil
 import subprocess
 import sys
+import threading
 import time
-from collections.abc import Iterable
 from enum import EnumMeta
 from pathlib import Path
 from typing import Tuple, Union, Dict
 
-import gepics
-
 from . import log
 
 ENUM_KEYS = [
@@ -19,9 +16,25 @@ ENUM_KEYS = [
     'EI', 'NI', 'TE', 'EL', 'TV', 'TT', 'FT', 'FF'
 ]
 
+IS_WINDOWS = platform.system() == 'Windows'
+
 logger = log.get_module_logger(__name__)
 
 
+def make_template(fields):
+    """
+    Build a database record template string for the given field set
+
+    :param fields: dictionary mapping field names to value templates
+    :return: format-ready template string
+    """
+    return '\n'.join(
+        ['record({record}, "$(device):{name}") {{'] +
+        [f'  field({k}, {v})' for k, v in fields.items()] +
+        ['}}', '']
+    )
+
+
 class RecordType(type):
     """Record MetaClass"""
 
@@ -31,6 +44,8 @@ class RecordType(type):
         fields.update(getattr(bases[0], 'fields', {}))
         fields.update(attrs.get('fields'))
         attrs['fields'] = fields
+        attrs['_template'] = make_template(fields)
+        attrs['_render'] = attrs['_template'].format
 
         return super(RecordType, cls).__new__(cls, name, bases, attrs)
 
@@ -44,27 +59,34 @@ class Record(object, metaclass=RecordType):
     :keyword *: additional keyword arguments
     """
 
+    __slots__ = ('options', '_instance_fields', '_render_cache')
+
     record = 'ai'
     fields = {
         'DESC': '{desc!r}',
     }
 
     def __init__(self, name, **kwargs):
-        kwargs.update(name=name, desc=kwargs.get("desc", "None"))
-        kw = {k: v for k, v in kwargs.items() if v is not None}
-        self.options = {}
-        self.options.update(kw)
+        kwargs['name'] = name
+        kwargs.setdefault('desc', 'None')
+        self.options = {k: v for k, v in kwargs.items() if v is not None}
         self.options['record'] = self.record
-        self.instance_fields = {}
-        self.instance_fields.update(self.fields)
+        self._instance_fields = None
+        self._render_cache = self._render
+
+    @property
+    def instance_fields(self):
+        """Database fields for this record instance, copied from the class fields on first access"""
+        if self._instance_fields is None:
+            self._instance_fields = dict(self.fields)
+        return self._instance_fields
 
     def __str__(self):
-        template = '\n'.join(
-            ['record({record}, "$(device):{name}") {{'] +
-            [f'  field({k}, {v})' for k, v in self.instance_fields.items()] +
-            ['}}', '']
-        )
-        return template.format(**self.options)
+        render = self._render_cache
+        if render is None:
+            # instance fields have been modified, rebuild and cache the template
+            render = self._render_cache = make_template(self.instance_fields).format
+        return render(**self.options)
 
     def add_field(self, key, value):
         """
@@ -75,6 +97,7 @@ class Record(object, metaclass=RecordType):
         :return:
         """
         self.instance_fields[key] = value
+        self._render_cache = None
 
     def del_field(self, key):
         """
@@ -84,6 +107,7 @@ class Record(object, metaclass=RecordType):
         """
         if key in self.instance_fields:
             del self.instance_fields[key]
+            self._render_cache = None
 
     def get(self, *args, **kwargs):
         ...
@@ -102,30 +126,35 @@ class Enum(Record):
     :keyword *: Extra keyword arguments
     """
 
+    __slots__ = ()
+
     record = 'mbbo'
     fields = {
         'VAL': '{default!r}',
         'OUT': '{out!r}'
     }
+    defaults = {
+        'choices': ('OFF', 'ON'),
+        'out': '',
+        'default': 0,
+    }
 
     def __init__(self, name, **kwargs):
-        kwargs.update(
-            choices=kwargs.get("choices", ["OFF", "ON"]),
-            out=kwargs.get("out", ""),
-            default=kwargs.get("default", 0)
-        )
+        kwargs = {**self.defaults, **kwargs}
         super(Enum, self).__init__(name, **kwargs)
-        if isinstance(self.options['choices'], EnumMeta):
-            choice_pairs = [(e.name.replace('_', ' '), e.value) for e in self.options['choices']]
-        elif isinstance(self.options['choices'], Iterable):
-            choice_pairs = [(c, i) for i, c in enumerate(self.options['choices'])]
+        choices = self.options['choices']
+        if isinstance(choices, EnumMeta):
+            choice_pairs = [(e.name.replace('_', ' '), e.value) for e in choices]
+        elif hasattr(choices, '__iter__'):
+            choice_pairs = [(c, i) for i, c in enumerate(choices)]
         else:
             choice_pairs = []
-        for i in range(len(choice_pairs)):
-            name, value = choice_pairs[i]
-            key = ENUM_KEYS[i]
-            self.add_field(f'{key}VL', f"{value}")
-            self.add_field(f'{key}ST', name)
+        self.instance_fields.update(
+            item
+            for (choice, value), key in zip(choice_pairs, ENUM_KEYS)
+            for item in ((f'{key}VL', f'{value}'), (f'{key}ST', choice))
+        )
+        self._render_cache = None
 
 
 class BinaryOutput(Record):
@@ -139,19 +168,22 @@ class BinaryOutput(Record):
     :keyword *: Extra keyword arguments
     """
 
+    __slots__ = ()
+
     record = 'mbboDirect'
     fields = {
         'VAL': '{default!r}',
         'OUT': '{out!r}',
         'SHFT': '{shift!r}',
     }
+    defaults = {
+        'out': '',
+        'default': 0,
+        'shift': 0,
+    }
 
     def __init__(self, name, **kwargs):
-        kwargs.update(
-            out=kwargs.get("out", ""),
-            default=kwargs.get("default", 0),
-            shift=kwargs.get("shift", 0)
-        )
+        kwargs = {**self.defaults, **kwargs}
         super(BinaryOutput, self).__init__(name, **kwargs)
 
 
@@ -165,19 +197,22 @@ class BinaryInput(Record):
     :keyword default: default value of the record, 0 by default. Sets the VAL field
     :keyword *: Extra keyword arguments
     """
+    __slots__ = ()
+
     record = 'mbbiDirect'
     fields = {
         'VAL': '{default!r}',
         'INP': '{inp!r}',
         'SHFT': '{shift!r}',
     }
+    defaults = {
+        'inp': '',
+        'default': 0,
+        'shift': 0,
+    }
 
     def __init__(self, name, **kwargs):
-        kwargs.update(
-            inp=kwargs.get("inp", ""),
-            default=kwargs.get("default", 0),
-            shift=kwargs.get("shift", 0)
-        )
+        kwargs = {**self.defaults, **kwargs}
         super(BinaryInput, self).__init__(name, **kwargs)
 
 
@@ -191,19 +226,21 @@ class Toggle(Record):
     :keyword oname: string value when high. Sets the ONAM field
     :keyword *: Extra keyword arguments
     """
+    __slots__ = ()
+
     record = 'bo'
     fields = {
         'ZNAM': '{zname!r}',
         'ONAM': '{oname!r}',
         'HIGH': '{high!r}'
     }
+    defaults = {
+        'high': 0.1,
+        'oname': '',
+    }
 
     def __init__(self, name, **kwargs):
-        kwargs.update(
-            high=kwargs.get("high", 0.1),
-            zname=kwargs.get("zname", name),
-            oname=kwargs.get("oname", "")
-        )
+        kwargs = {**self.defaults, 'zname': name, **kwargs}
         super(Toggle, self).__init__(name, **kwargs)
 
 
@@ -212,6 +249,8 @@ class String(Record):
     String record. Uses standard string record, or character array depending on length
     """
 
+    __slots__ = ()
+
     record = 'stringout'
     fields = {
         'VAL': '{default!r}'
@@ -227,10 +266,8 @@ class String(Record):
         :param *: Extra keyword arguments
 
         """
-        kwargs.update(
-            max_length=max_length,
-            default=default
-        )
+        kwargs['max_length'] = max_length
+        kwargs['default'] = default
         super(String, self).__init__(name, **kwargs)
         if self.options['max_length'] > 40:
             self.options['record'] = 'waveform'
@@ -250,6 +287,8 @@ class Integer(Record):
     :param units:  engineering units (str), default empty string. Sets the EGU field
     :param kwargs: Extra keyword arguments
     """
+    __slots__ = ()
+
     record = 'longout'
     fields = {
         'HOPR': '{max_val!r}',
@@ -269,12 +308,10 @@ class Integer(Record):
             units: str = '',
             **kwargs
     ):
-        kwargs.update(
-            max_val=max_val,
-            min_val=min_val,
-            default=default,
-            units=units,
-        )
+        kwargs['max_val'] = max_val
+        kwargs['min_val'] = min_val
+        kwargs['default'] = default
+        kwargs['units'] = units
         super(Integer, self).__init__(name, **kwargs)
 
 
@@ -291,6 +328,8 @@ class Float(Record):
     :param kwargs: Extra keyword arguments
     """
 
+    __slots__ = ()
+
     record = 'ao'
     fields = {
         'DRVH': '{max_val!r}',
@@ -312,13 +351,11 @@ class Float(Record):
             units: str = '',
             **kwargs
     ):
-        kwargs.update(
-            max_val=max_val,
-            min_val=min_val,
-            default=default,
-            prec=prec,
-            units=units,
-        )
+        kwargs['max_val'] = max_val
+        kwargs['min_val'] = min_val
+        kwargs['default'] = default
+        kwargs['prec'] = prec
+        kwargs['units'] = units
         super(Float, self).__init__(name, **kwargs)
 
 
@@ -334,12 +371,15 @@ class Calc(Record):
     :param kwargs: Extra keyword arguments. Any additional database fields required should be specified as lower-case kwargs.
     """
 
+    __slots__ = ()
+
     record = 'calc'
     fields = {
         'CALC': '{calc!r}',
         'SCAN': '{scan!r}',
         'PREC': '{prec!r}',
     }
+    INP_KEYS = tuple((f'INP{c}', f'inp{c.lower()}') for c in 'ABCDEFGHIJKL')
 
     def __init__(
             self,
@@ -349,16 +389,13 @@ class Calc(Record):
             calc: str = '',
             **kwargs
     ):
-        kwargs.update(
-            scan=scan,
-            prec=prec,
-            calc=calc
-        )
+        kwargs['scan'] = scan
+        kwargs['prec'] = prec
+        kwargs['calc'] = calc
         super(Calc, self).__init__(name, **kwargs)
-        for c in 'ABCDEFGHIJKL':
-            key = f'INP{c}'
-            if key.lower() in self.options:
-                self.add_field(key, self.options[key.lower()])
+        for key, kwarg in self.INP_KEYS:
+            if kwarg in self.options:
+                self.add_field(key, self.options[kwarg])
 
 
 class CalcOut(Calc):
@@ -366,6 +403,8 @@ class CalcOut(Calc):
     CalcOutput Record
     """
 
+    __slots__ = ()
+
     record = 'calcout'
     fields = {
         'OOPT': '{oopt!r}',
@@ -382,7 +421,9 @@ class CalcOut(Calc):
         :param *: Extra keyword arguments, supports Calc kwargs also.
 
         """
-        kwargs.update(out=out, oopt=oopt, dopt=dopt)
+        kwargs['out'] = out
+        kwargs['oopt'] = oopt
+        kwargs['dopt'] = dopt
         super(CalcOut, self).__init__(name, **kwargs)
 
 
@@ -395,6 +436,8 @@ class Array(Record):
     :param length: Number of elements in the array
     :param kwargs: Extra kwargs
     """
+    __slots__ = ()
+
     record = 'waveform'
     fields = {
         'NELM': '{length!r}',
@@ -402,7 +445,8 @@ class Array(Record):
     }
 
     def __init__(self, name, type: Union[str, type] = int, length: Union[int, str] = 256, **kwargs):
-        kwargs.update(type=type, length=length)
+        kwargs['type'] = type
+        kwargs['length'] = length
         super(Array, self).__init__(name, **kwargs)
         element_type = self.options['type']
         self.options['type'] = {
@@ -422,33 +466,11 @@ dbl
 
 class ModelType(type):
     def __new__(cls, name, bases, attrs):
-        fields = {}
-        for k, v in list(attrs.items()):
-            if isinstance(v, Record):
-                fields[k] = v
-                del attrs[k]
-        attrs['_fields'] = fields
-        return super(ModelType, cls).__new__(cls, name, bases, attrs)
-
-
-def run_softioc(args, stdin_id, stdout_id):
-    """
-    Launch EPICS ioc binary
-
-
-    :param args:
-    :param stdin_id: Standard input file descriptor
-    :param stdout_id: Standard output file descriptor
-    :return:
-    """
-
-    if platform.system() == 'Windows':
-        # output redirection not needed on Windows
-        subprocess.check_call(args)
-    else:
-        with os.fdopen(stdout_id) as stdout:
-            with os.fdopen(stdin_id) as stdin:
-                subprocess.check_call(args, stdin=stdin, stdout=stdout)
+        fields = {k: v for k, v in attrs.items() if isinstance(v, Record)}
+        new_attrs = {k: v for k, v in attrs.items() if k not in fields}
+        new_attrs['_fields'] = fields
+        new_attrs['_field_items'] = tuple((k, f'do_{k}'.lower(), v) for k, v in fields.items())
+        return super(ModelType, cls).__new__(cls, name, bases, new_attrs)
 
 
 class Model(object, metaclass=ModelType):
@@ -476,11 +498,17 @@ class Model(object, metaclass=ModelType):
     """
 
     _fields: Dict[str, Record]
+    _field_items: Tuple[Tuple[str, str, Record], ...]
 
     def __init__(self, device_name, callbacks=None, command='softIoc', macros=None):
         self.device_name = device_name
         self.db_name = self.__class__.__name__
         self.callbacks = callbacks or self
+        self._callbacks = {
+            n: getattr(self.callbacks, n)
+            for n in dir(self.callbacks)
+            if n.startswith('do_') and callable(getattr(self.callbacks, n, None))
+        }
         self.ioc_process = None
         self.macros = {'device': self.device_name}
         if isinstance(macros, dict):
@@ -493,23 +521,28 @@ class Model(object, metaclass=ModelType):
         self._startup()
         self._setup()
 
+    def render_db(self) -> str:
+        """
+        Render the database text for all records in the model
+        :return: database text
+        """
+        return ''.join(str(v) for k, cb_name, v in self._field_items)
+
     def save_db(self) -> Tuple[Path, Path]:
         """
         Save the database and command files
         :return: Tuple of database and command file paths
         """
 
-        if not self.db_cache_dir.exists():
-            self.db_cache_dir.mkdir(parents=True, exist_ok=True)
+        self.db_cache_dir.mkdir(parents=True, exist_ok=True)
 
         db_filename = self.db_cache_dir / f'{self.db_name}.db'
         cmd_filename = self.db_cache_dir / f'{self.db_name}.cmd'
-        with open(db_filename, 'w') as db_file:
-            for k, v in self._fields.items():
-                db_file.write(str(v))
+        with open(db_filename, 'wb', buffering=1 << 16) as db_file:
+            db_file.write(self.render_db().encode('utf-8'))
 
         with open(cmd_filename, 'w') as cmd_file:
-            macro_text = ','.join([f'{k}={v}' for k, v in self.macros.items()])
+            macro_text = ','.join(f'{k}={v}' for k, v in self.macros.items())
             cmd_file.write(CMD_TEMPLATE.format(macros=macro_text, db_name=self.db_name))
 
         return db_filename, cmd_filename
@@ -521,15 +554,15 @@ class Model(object, metaclass=ModelType):
 
         self.save_db()
 
-        os.chdir(self.db_cache_dir)
         args = [self.command, f'{self.db_name}.cmd']
 
-        self.ioc_process = multiprocessing.Process(
-            target=run_softioc,
-            args=(args, sys.stdin.fileno(), sys.stdout.fileno()),
+        self.ioc_process = subprocess.Popen(
+            args,
+            stdin=sys.stdin,
+            stdout=sys.stdout,
+            cwd=self.db_cache_dir,
+            start_new_session=not IS_WINDOWS,
         )
-        self.ioc_process.daemon = True
-        self.ioc_process.start()
 
     def shutdown(self):
         """
@@ -537,12 +570,18 @@ class Model(object, metaclass=ModelType):
         """
 
         self.ioc_process.terminate()
-        subprocess.check_call('reset', shell=True)
-        shutil.rmtree(self.db_cache_dir)
-        self.ioc_process.join()
+        if not IS_WINDOWS and sys.stdout.isatty():
+            # same reset sequence the reset(1) utility emits for VT100-compatible terminals
+            sys.stdout.write('\033c\033[!p\033[?3;4l\033[4l\033>')
+            sys.stdout.flush()
+        try:
+            shutil.rmtree(self.db_cache_dir)
+        except OSError:
+            pass
+        self.ioc_process.wait()
 
     def connect_callbacks(self, pv, value, name):
-        callback = getattr(self.callbacks, name, None)
+        callback = self._callbacks.get(name)
         pv.disconnect('changed')
         if callback:
             pv.connect('changed', callback, self)
@@ -552,22 +591,40 @@ class Model(object, metaclass=ModelType):
         """
         Set up the ioc records and connect all callbacks
         """
+        from gepics import PV
+
         pending = set()
-        for k, f in self._fields.items():
+        for k, cb_name, f in self._field_items:
             pv_name = f'{self.device_name}:{f.options["name"]}'
-            callback_name = f'do_{k}'.lower()
-            pv = gepics.PV(pv_name)
+            pv = PV(pv_name)
             setattr(self, k, pv)
-            callback = getattr(self.callbacks, callback_name, None)
+            callback = self._callbacks.get(cb_name)
             if callback:
                 pv.connect('changed', callback, self)
             pending.add(pv)
 
         # wait for all PVs to connect
+        connected = threading.Event()
+        lock = threading.Lock()
+
+        def on_active(pv, active):
+            if active:
+                with lock:
+                    pending.discard(pv)
+                    if not pending:
+                        connected.set()
+
+        for pv in list(pending):
+            pv.connect('active', on_active)
+
+        # gepics delivers signals through the GLib main loop, which may not be running
+        # during startup, so also re-check the PV states directly while waiting
         timeout = time.time() + 5
         while pending and time.time() < timeout:
-            time.sleep(0.025)
-            pending = {pv for pv in pending if not pv.is_active()}
+            connected.wait(timeout=0.025)
+            with lock:
+                for pv in [p for p in pending if p.is_active()]:
+                    pending.discard(pv)
 
         self.ready = True
         print('')